@@ -1,13 +1,29 @@
+import asyncio
+import concurrent.futures
+import copy
+import functools
 import os
 import base64
-import traceback
+import hashlib
+import tempfile
+import time
 import json
+import logging
 import re
 from fastapi import FastAPI, UploadFile, File, HTTPException
-from pdf2image import convert_from_bytes
+from pdf2image import convert_from_bytes, convert_from_path
 from io import BytesIO
+import httpx
 from PIL import Image
-from openai import OpenAI
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError, RateLimitError
+from pydantic import BaseModel, ConfigDict, ValidationError, field_validator
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pybase64  # SIMD base64, 3-5x faster than stdlib on large buffers
+except ImportError:
+    pybase64 = None
 
 # ---------------- CONFIG ----------------
 # Poppler: on Windows, set POPPLER_PATH to the folder containing pdftoppm.exe (e.g. C:\Program Files\poppler\Library\bin)
@@ -18,14 +34,198 @@ MODEL_NAME = "qwen-vl-max"
 # QWEN_API_KEY = os.getenv("DASHSCOPE_API_KEY", "YOUR_API_KEY_HERE")
 #sk-647cb6d403874749b16484ccbbbfb654
 QWEN_API_KEY = 'sk-85db8875d6e74de9a2331951797d03f1'
-client = OpenAI(
-    api_key=QWEN_API_KEY,
-    base_url="https://dashscope-intl.aliyuncs.com/compatible-mode/v1",
-)
+DEFAULT_BASE_URL = "https://dashscope-intl.aliyuncs.com/compatible-mode/v1"
+
+# ---------------- ENDPOINT POOL ----------------
+# Calls are spread over one or more OpenAI-compatible endpoints (DashScope,
+# self-hosted vLLM, ...) with per-endpoint concurrency limits and failover.
+# Configure via QWEN_ENDPOINTS, a JSON list of
+#   {"base_url": ..., "api_key": ..., "concurrency_limit": ...}
+# entries; unset means the single default DashScope endpoint.
+QWEN_ENDPOINT_COOLDOWN_S = float(os.getenv("QWEN_ENDPOINT_COOLDOWN_S", "30"))
+
+
+def _make_http_client() -> httpx.AsyncClient:
+    # Async client so the event loop is free during the (5-30s) Qwen
+    # round-trip, over a keep-alive pool with HTTP/2 multiplexing.
+    # Generous read timeout: long invoices can decode for minutes.
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        timeout=httpx.Timeout(300.0, connect=5.0),
+    )
+
+
+class Endpoint:
+    """One upstream Qwen endpoint plus its load/health bookkeeping."""
+
+    def __init__(self, base_url: str, api_key: str, concurrency_limit: int = 16):
+        self.base_url = base_url
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=_make_http_client())
+        self.concurrency_limit = concurrency_limit
+        self.inflight = 0
+        self.ema_latency = 0.0
+        self.unhealthy_until = 0.0
+
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def load(self) -> float:
+        return self.inflight / self.concurrency_limit
+
+    def note_latency(self, seconds: float):
+        self.ema_latency = seconds if not self.ema_latency else 0.8 * self.ema_latency + 0.2 * seconds
+
+
+class EndpointPool:
+    """Routes each call to the least-loaded healthy endpoint."""
+
+    def __init__(self, endpoints: list):
+        self.endpoints = endpoints
+
+    def pick(self, exclude=()) -> Endpoint:
+        candidates = [
+            e for e in self.endpoints
+            if e.healthy() and e not in exclude and e.inflight < e.concurrency_limit
+        ]
+        if not candidates:
+            # Everything saturated/cooling down — fall back to best effort
+            candidates = [e for e in self.endpoints if e not in exclude] or list(self.endpoints)
+        return min(candidates, key=lambda e: (e.load(), e.ema_latency))
+
+    def mark_unhealthy(self, endpoint: Endpoint):
+        endpoint.unhealthy_until = time.monotonic() + QWEN_ENDPOINT_COOLDOWN_S
+
+
+def _load_endpoints() -> list:
+    raw = os.getenv("QWEN_ENDPOINTS")
+    if not raw:
+        return [Endpoint(DEFAULT_BASE_URL, QWEN_API_KEY)]
+    return [
+        Endpoint(
+            cfg["base_url"],
+            cfg.get("api_key", QWEN_API_KEY),
+            int(cfg.get("concurrency_limit", 16)),
+        )
+        for cfg in json.loads(raw)
+    ]
+
+
+endpoint_pool = EndpointPool(_load_endpoints())
+
+# ---------------- RESPONSE CACHE ----------------
+# Identical PDFs are resubmitted constantly in ERP retry flows. Cache Qwen
+# responses on disk keyed by (model, prompt, file content) so a resubmission
+# skips both the poppler render and the Qwen round-trip entirely.
+CACHE_DIR = os.environ.get("QWEN_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+
+
+class ExtractionCache:
+    """On-disk content-addressable cache of Qwen responses ({key}.json files)."""
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str):
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def put(self, key: str, value: str):
+        # Write-then-rename so concurrent readers never see a partial file
+        tmp_path = f"{self._path(key)}.tmp.{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, self._path(key))
+
+
+extraction_cache = ExtractionCache(CACHE_DIR)
+
+
+def cache_key(file_sha: str, prompt: str) -> str:
+    """Content hash of (model, prompt, pdf bytes) — any change busts the entry."""
+    prompt_sha = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    return hashlib.sha256(f"{MODEL_NAME}:{prompt_sha}:{file_sha}".encode("ascii")).hexdigest()
+
 
 # ---------------- APP ----------------
 app = FastAPI(title="Qwen Invoice OCR API")
 
+# convert_from_bytes shells out to pdftoppm and blocks for the whole render;
+# run it in a thread pool so the event loop keeps serving other requests.
+_pdf_executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+
+# Uploads up to this size stay in memory; bigger ones spill to a temp file so
+# a 100 MB weight slip PDF doesn't pin 100 MB per concurrent request.
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+
+class UploadStream:
+    """An upload spooled to memory or a temp file plus its content SHA-256."""
+
+    def __init__(self, spool, rolled: bool, sha: str):
+        self.spool = spool
+        self.rolled = rolled
+        self.sha = sha
+
+    def close(self):
+        self.spool.close()
+        if self.rolled:
+            # Spilled files are created with delete=False (see read_upload);
+            # clean up by hand once the request is done with them
+            try:
+                os.unlink(self.spool.name)
+            except OSError:
+                pass
+
+
+async def read_upload(pdf: UploadFile) -> UploadStream:
+    """Stream the upload chunk by chunk, hashing as the chunks arrive.
+
+    Avoids materializing large bodies in memory and gives us the cache key
+    without a second pass over the bytes. Spilling is done by hand rather
+    than with SpooledTemporaryFile because its backing file is anonymous on
+    Linux (no usable .name), and poppler needs a real path for spilled PDFs.
+    """
+    hasher = hashlib.sha256()
+    spool = BytesIO()
+    rolled = False
+    size = 0
+    while chunk := await pdf.read(UPLOAD_CHUNK_SIZE):
+        hasher.update(chunk)
+        size += len(chunk)
+        if not rolled and size > SPOOL_MAX_SIZE:
+            # delete=False: on Windows a NamedTemporaryFile held open with
+            # delete=True can't be reopened by name, and pdftoppm opens the
+            # path as a separate process. UploadStream.close() unlinks it.
+            disk = tempfile.NamedTemporaryFile(delete=False)
+            disk.write(spool.getbuffer())
+            spool = disk
+            rolled = True
+        spool.write(chunk)
+    spool.seek(0)
+    return UploadStream(spool, rolled, hasher.hexdigest())
+
+
+async def render_pdf(upload: UploadStream):
+    # Only page 1 is ever sent to Qwen, so don't rasterize the rest.
+    loop = asyncio.get_running_loop()
+    common = dict(dpi=300, first_page=1, last_page=1, thread_count=1, poppler_path=POPPLER_PATH)
+    if upload.rolled:
+        # Already on disk — hand poppler the path instead of re-reading the bytes
+        upload.spool.flush()
+        convert = functools.partial(convert_from_path, upload.spool.name, **common)
+    else:
+        convert = functools.partial(convert_from_bytes, upload.spool.read(), **common)
+    return await loop.run_in_executor(_pdf_executor, convert)
+
 # ---------------- PROMPT ----------------
 PROMPT = """
 You are an expert invoice data extraction engine.
@@ -202,104 +402,494 @@ STRICT RULES:
 """
 
 
-# ---------------- QWEN OCR CALL ----------------
-def call_qwen(image: Image.Image):
+# ---------------- OUTPUT SCHEMAS ----------------
+# Mirrors the JSON schema spelled out in PROMPT / WEIGHT_PROMPT. Validation is
+# Rust-backed (pydantic v2) and a failure re-prompts the model with the error
+# instead of silently shipping malformed output to the caller.
+
+
+class ItemOut(BaseModel):
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+
+    itemName: str = ""
+    quantity: str = ""
+    unitPrice: str = ""
+    amount: str = ""
+    hsnSac: str = ""
+    taxableValue: str = ""
+    cgstPercent: str = ""
+    cgstAmount: str = ""
+    sgstPercent: str = ""
+    sgstAmount: str = ""
+
+
+class InvoiceOut(BaseModel):
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+
+    # All top-level keys required — the prompt's contract is "Always include
+    # all keys", and defaults would let {} or a JSON-shaped refusal pass
+    # validation and end up in the content cache
+    invoiceNumber: str
+    invoiceDate: str
+    poNumber: str
+    supplierName: str
+    billTo: str
+    billToAddress: str
+    billToGst: str
+    items: list[ItemOut]
+    subtotal: str
+    cgst: str
+    sgst: str
+    roundOff: str
+    taxAmount: str
+    totalAmount: str
+    totalAmountInWords: str
+
+
+class WeightOut(BaseModel):
+    weight: float | None = None
+
+    @field_validator("weight", mode="before")
+    @classmethod
+    def _empty_as_missing(cls, value):
+        # The prompt's format example shows "", so treat it as not-found
+        return None if value == "" else value
+
+
+# Static message scaffolding built once at import — per request we only
+# deep-copy the skeleton and drop in the image data URL (the prompt strings
+# are immutable, so they are shared, not copied).
+# The static prompt comes first so provider-side prefix caching can reuse its
+# prefill across requests; only the image tokens vary per call.
+def _message_template(prompt: str):
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt},
+                {"type": "image_url", "image_url": {"url": None}},
+            ],
+        }
+    ]
+
+
+_INVOICE_MESSAGES = _message_template(PROMPT)
+_WEIGHT_MESSAGES = _message_template(WEIGHT_PROMPT)
+
+
+def build_messages(template, data_url: str):
+    messages = copy.deepcopy(template)
+    messages[0]["content"][1]["image_url"]["url"] = data_url
+    return messages
+
+
+# ---------------- QWEN RATE CONTROL ----------------
+# Backpressure so a traffic spike doesn't blow past DashScope's rate limits
+# and degenerate into 429 retry storms: cap in-flight calls per worker and
+# smooth the request rate with a token bucket.
+QWEN_CONCURRENCY = int(os.getenv("QWEN_CONCURRENCY", "16"))
+QWEN_MAX_QPS = float(os.getenv("QWEN_MAX_QPS", "8"))
+QWEN_MAX_RETRIES = 2
+
+_qwen_sem = asyncio.Semaphore(QWEN_CONCURRENCY)
+
+
+class TokenBucket:
+    """Async token bucket: holds up to `rate` tokens, refilled at `rate`/s."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self.tokens) / self.rate)
+
+
+_qps_bucket = TokenBucket(QWEN_MAX_QPS)
+
+
+async def create_completion(**kwargs):
+    """Rate-limited chat completion routed through the endpoint pool.
+
+    Failures put the endpoint on cooldown and fail over to the next one
+    immediately; backoff (1s, 2s) only kicks in once every endpoint has
+    been tried in the current attempt round. 4xx other than 429 fail fast.
+    """
+    async with _qwen_sem:
+        tried = []
+        for attempt in range(QWEN_MAX_RETRIES + 1):
+            await _qps_bucket.acquire()
+            endpoint = endpoint_pool.pick(exclude=tried)
+            endpoint.inflight += 1
+            started = time.monotonic()
+            try:
+                completion = await endpoint.client.chat.completions.create(**kwargs)
+                endpoint.note_latency(time.monotonic() - started)
+                return completion
+            except (RateLimitError, APIConnectionError):
+                endpoint_pool.mark_unhealthy(endpoint)
+                tried.append(endpoint)
+                if attempt == QWEN_MAX_RETRIES:
+                    raise
+            except APIStatusError as e:
+                if e.status_code < 500:
+                    raise
+                endpoint_pool.mark_unhealthy(endpoint)
+                tried.append(endpoint)
+                if attempt == QWEN_MAX_RETRIES:
+                    raise
+            finally:
+                endpoint.inflight -= 1
+
+            if len(tried) >= len(endpoint_pool.endpoints):
+                tried = []
+                await asyncio.sleep(1.0 * (attempt + 1))
+
+
+# ---------------- BATCH MODE ----------------
+# Invoice OCR is often fire-and-forget in ERP flows. Callers that can wait
+# (latency_budget_ms >= 30s) get pooled into one provider Batch API job —
+# roughly half the per-token price at minute-scale latency — instead of an
+# interactive completion. Interactive callers keep the normal path.
+QWEN_BATCH_MAX_SIZE = int(os.getenv("QWEN_BATCH_MAX_SIZE", "100"))
+QWEN_BATCH_WINDOW_MS = int(os.getenv("QWEN_BATCH_WINDOW_MS", "30000"))
+QWEN_BATCH_MIN_BUDGET_MS = 30_000
+QWEN_BATCH_POLL_S = 10.0
+# Give up on a batch stuck upstream after this long (default: the 24h
+# completion window) so awaiting requests fail instead of hanging forever
+QWEN_BATCH_MAX_POLL_S = float(os.getenv("QWEN_BATCH_MAX_POLL_S", str(24 * 3600)))
+
+_batch_queue: asyncio.Queue = asyncio.Queue()
+_batch_flusher_task = None
+# Strong references to in-flight submissions — the loop only holds weak refs,
+# and a GC'd polling task would leave its whole batch awaiting forever
+_batch_submit_tasks: set = set()
+
+
+async def enqueue_batch_completion(body: dict) -> str:
+    """Queue one completion for the next batch submission and await its text."""
+    fut = asyncio.get_running_loop().create_future()
+    await _batch_queue.put((body, fut))
+    return await fut
+
+
+async def _submit_batch(items):
+    """Submit queued completions as one Batch API job and resolve the futures."""
+    endpoint = endpoint_pool.pick()
+    lines = [
+        json.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": body,
+        })
+        for i, (body, _) in enumerate(items)
+    ]
+    try:
+        batch_file = await endpoint.client.files.create(
+            file=("batch.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch",
+        )
+        batch = await endpoint.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        poll_deadline = time.monotonic() + QWEN_BATCH_MAX_POLL_S
+        while batch.status in ("validating", "in_progress", "finalizing"):
+            if time.monotonic() >= poll_deadline:
+                raise Exception(
+                    f"Batch {batch.id} still {batch.status} after "
+                    f"{QWEN_BATCH_MAX_POLL_S:.0f}s; giving up"
+                )
+            await asyncio.sleep(QWEN_BATCH_POLL_S)
+            batch = await endpoint.client.batches.retrieve(batch.id)
+        if batch.status != "completed" or not batch.output_file_id:
+            raise Exception(f"Batch {batch.id} ended with status {batch.status}")
+
+        output = await endpoint.client.files.content(batch.output_file_id)
+        results = {}
+        for line in output.text.splitlines():
+            if line.strip():
+                record = json.loads(line)
+                results[record.get("custom_id")] = record
+
+        for i, (_, fut) in enumerate(items):
+            if fut.done():
+                continue
+            record = results.get(str(i))
+            response = (record or {}).get("response") or {}
+            if response.get("status_code") == 200:
+                fut.set_result(response["body"]["choices"][0]["message"]["content"])
+            else:
+                fut.set_exception(Exception(f"Batch item {i} failed: {record}"))
+    except Exception as e:
+        for _, fut in items:
+            if not fut.done():
+                fut.set_exception(e)
+
+
+async def _batch_flusher():
+    """Collect queued items up to the batch size or window, then submit."""
+    while True:
+        items = [await _batch_queue.get()]
+        deadline = time.monotonic() + QWEN_BATCH_WINDOW_MS / 1000.0
+        while len(items) < QWEN_BATCH_MAX_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(_batch_queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        # Submission polls for minutes — run it as its own task so the next
+        # window starts collecting immediately
+        task = asyncio.ensure_future(_submit_batch(items))
+        _batch_submit_tasks.add(task)
+        task.add_done_callback(_batch_submit_tasks.discard)
+
+
+@app.on_event("startup")
+async def _start_batch_flusher():
+    global _batch_flusher_task
+    _batch_flusher_task = asyncio.create_task(_batch_flusher())
+
 
+# ---------------- QWEN OCR CALL ----------------
+# Qwen-VL's vision tower downsamples anyway, so a 300-dpi PNG (~2500x3500 px,
+# multi-MB) just inflates the payload and the vision token bill. Cap the long
+# edge and send JPEG instead.
+IMAGE_MAX_EDGE = 1600
+JPEG_QUALITY = 85
+
+
+def _b64encode(view) -> str:
+    if pybase64 is not None:
+        return pybase64.b64encode_as_string(view)
+    return base64.b64encode(view).decode("ascii")
+
+
+def _encode_image(image: Image.Image, grayscale: bool) -> str:
+    image.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.LANCZOS)
+    if grayscale:
+        # Monochrome text on white — 8-bit luminance keeps every glyph while
+        # dropping two channels' worth of bytes and vision tokens
+        image = image.convert("L")
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
     buf = BytesIO()
-    image.save(buf, format="PNG")
-    buf.seek(0)
+    image.save(buf, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    # getbuffer() is a zero-copy view, so base64 is the only pass over the
+    # compressed bytes
+    return f"data:image/jpeg;base64,{_b64encode(buf.getbuffer())}"
 
-    b64 = base64.b64encode(buf.getvalue()).decode()
-    data_url = f"data:image/png;base64,{b64}"
 
-    completion = client.chat.completions.create(
-        model=MODEL_NAME,
-        messages=[
-            {
+async def image_to_data_url(image: Image.Image, grayscale: bool = False) -> str:
+    # Resize, JPEG-encode and base64 are all pure CPU — one executor hop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pdf_executor, _encode_image, image, grayscale)
+
+
+VALIDATION_MAX_RETRIES = 2
+
+
+def passes_schema(text: str, schema: type[BaseModel]) -> bool:
+    try:
+        schema.model_validate_json(text)
+        return True
+    except ValidationError:
+        return False
+
+
+async def validated_completion(request_body: dict, schema: type[BaseModel]) -> tuple[str, bool]:
+    """Call Qwen and validate the output, re-prompting with the validation
+    error up to VALIDATION_MAX_RETRIES times before giving up.
+
+    Returns (text, validated). After the last retry the unvalidated text is
+    still returned (logged) rather than failing the whole request, but the
+    False flag tells callers not to cache it — a resubmission should get a
+    fresh inference, not the bad output replayed forever.
+    """
+    for attempt in range(VALIDATION_MAX_RETRIES + 1):
+        completion = await create_completion(
+            **request_body,
+            extra_body={"use_cache": True}
+        )
+        qwen_text = completion.choices[0].message.content
+        try:
+            schema.model_validate_json(qwen_text)
+            return qwen_text, True
+        except ValidationError as e:
+            if attempt == VALIDATION_MAX_RETRIES:
+                logger.warning("Qwen output failed %s validation after %d retries: %s",
+                               schema.__name__, VALIDATION_MAX_RETRIES, e)
+                return qwen_text, False
+            logger.info("Qwen output failed %s validation, re-prompting: %s", schema.__name__, e)
+            request_body["messages"].append({"role": "assistant", "content": qwen_text})
+            request_body["messages"].append({
                 "role": "user",
-                "content": [
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": data_url
-                        }
-                    },
-                    {
-                        "type": "text",
-                        "text": PROMPT
-                    }
-                ]
-            }
-        ],
+                "content": f"Your output had this validation error: {e}. "
+                           "Fix it and return ONLY the corrected JSON.",
+            })
+            await asyncio.sleep(1.0 * (attempt + 1))
+
+
+async def call_qwen(image: Image.Image, latency_budget_ms: int = 0):
+
+    data_url = await image_to_data_url(image)
+
+    request_body = dict(
+        model=MODEL_NAME,
+        messages=build_messages(_INVOICE_MESSAGES, data_url),
         temperature=0,
-        max_tokens=8192   # Enough for long invoices with many line items (was 1200, caused truncation)
+        max_tokens=8192,  # Enough for long invoices with many line items (was 1200, caused truncation)
+        response_format={"type": "json_object"},
     )
 
-    return completion.choices[0].message.content
+    if latency_budget_ms >= QWEN_BATCH_MIN_BUDGET_MS:
+        qwen_text = await enqueue_batch_completion(request_body)
+        return qwen_text, passes_schema(qwen_text, InvoiceOut)
 
+    return await validated_completion(request_body, InvoiceOut)
 
-def call_qwen_weight(image: Image.Image):
-    """Extract weight from weight slip image"""
-    buf = BytesIO()
-    image.save(buf, format="PNG")
-    buf.seek(0)
 
-    b64 = base64.b64encode(buf.getvalue()).decode()
-    data_url = f"data:image/png;base64,{b64}"
+async def call_qwen_weight(image: Image.Image):
+    """Extract weight from weight slip image"""
+    data_url = await image_to_data_url(image, grayscale=True)
 
-    completion = client.chat.completions.create(
+    request_body = dict(
         model=MODEL_NAME,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": data_url
-                        }
-                    },
-                    {
-                        "type": "text",
-                        "text": WEIGHT_PROMPT
-                    }
-                ]
-            }
-        ],
+        messages=build_messages(_WEIGHT_MESSAGES, data_url),
         temperature=0,
-        max_tokens=200
+        max_tokens=32,    # response is just {"weight": <number>}
+        response_format={"type": "json_object"},
     )
 
-    return completion.choices[0].message.content
+    return await validated_completion(request_body, WeightOut)
+
+
+# ---------------- IN-FLIGHT DEDUP ----------------
+# Two users uploading the same PDF seconds apart (common in ERP batch flows)
+# should not pay for two Qwen calls: later requests await the first's result.
+_inflight: dict[str, asyncio.Future] = {}
+
+
+async def dedup_inflight(key: str, run):
+    """Run `run()` unless an identical request is already in flight, in which
+    case await and share its result."""
+    fut = _inflight.get(key)
+    if fut is not None:
+        return await fut
+
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[key] = fut
+    try:
+        result = await run()
+        fut.set_result(result)
+        return result
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # mark retrieved even if nobody else is waiting
+        raise
+    finally:
+        _inflight.pop(key, None)
 
 
 # ---------------- API ----------------
 IMAGE_CONTENT_TYPES = {"image/png", "image/jpeg", "image/jpg", "image/webp"}
 
+# Fallback extractor for a model that ignores JSON mode and wraps the object
+# in prose; compiled once instead of per request
+_JSON_RE = re.compile(r'\{.*\}', re.DOTALL)
+
+# PNG, JPEG (all markers), WebP/RIFF — phone uploads often arrive with a
+# wrong or generic content type, and running poppler on them fails hard
+_IMAGE_MAGIC_PREFIXES = (b"\x89PNG", b"\xff\xd8\xff", b"RIFF")
+
+
+def is_image_upload(content_type: str, upload: UploadStream) -> bool:
+    if content_type in IMAGE_CONTENT_TYPES:
+        return True
+    head = upload.spool.read(4)
+    upload.spool.seek(0)
+    return head.startswith(_IMAGE_MAGIC_PREFIXES)
+
+
+async def probe_cache(key: str):
+    # Small file read, but still disk I/O — keep it off the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, extraction_cache.get, key)
+
+
+async def store_cache(key: str, value: str):
+    # Same deal as probe_cache: the write + os.replace are disk I/O
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, extraction_cache.put, key, value)
+
+
+def start_speculative_render(upload: UploadStream, is_image: bool, key: str):
+    """Kick off the poppler render so it overlaps with the cache probe.
+
+    Callers cancel the returned task on a cache hit; if poppler already
+    started, the wasted render finishes in its worker thread and is dropped.
+    Returns None for direct image uploads and for requests that will
+    piggyback on an identical in-flight one.
+    """
+    if is_image or key in _inflight:
+        return None
+    return asyncio.ensure_future(render_pdf(upload))
+
 
 @app.post("/ocr")
-async def extract_invoice(pdf: UploadFile = File(...)):
+async def extract_invoice(pdf: UploadFile = File(...), latency_budget_ms: int = 0):
+    upload = None
+    render_task = None
     try:
-        file_bytes = await pdf.read()
+        upload = await read_upload(pdf)
         content_type = (pdf.content_type or "").lower().split(";")[0].strip()
+        is_image = is_image_upload(content_type, upload)
+
+        key = cache_key(upload.sha, PROMPT)
+        render_task = start_speculative_render(upload, is_image, key)
+        cached = await probe_cache(key)
+        if cached is not None:
+            logger.info("Cache hit, skipping Qwen call")
+            return {
+                "success": True,
+                "invoice_json": cached
+            }
 
-        if content_type in IMAGE_CONTENT_TYPES:
-            invoice_page = Image.open(BytesIO(file_bytes))
-            if invoice_page.mode not in ("RGB", "RGBA"):
-                invoice_page = invoice_page.convert("RGB")
-            print("\nImage loaded for OCR")
-        else:
-            images = convert_from_bytes(file_bytes, dpi=300, poppler_path=POPPLER_PATH)
-            if not images:
-                raise Exception("PDF conversion failed")
-            invoice_page = images[0]
-            print("\nPDF converted to image")
+        async def run_pipeline():
+            if is_image:
+                invoice_page = Image.open(upload.spool)
+                if invoice_page.mode not in ("RGB", "RGBA"):
+                    invoice_page = invoice_page.convert("RGB")
+                logger.debug("Image loaded for OCR")
+            else:
+                images = await (render_task if render_task is not None else render_pdf(upload))
+                if not images:
+                    raise Exception("PDF conversion failed")
+                invoice_page = images[0]
+                logger.debug("PDF converted to image")
+
+            qwen_text, validated = await call_qwen(invoice_page, latency_budget_ms)
+            if validated:
+                await store_cache(key, qwen_text)
+            return qwen_text
 
-        qwen_text = call_qwen(invoice_page)
+        qwen_text = await dedup_inflight(key, run_pipeline)
 
-        print("\n========== QWEN OUTPUT ==========\n")
-        print(qwen_text)
-        print("\n===============================\n")
+        logger.debug("Qwen output: %s", qwen_text)
 
         return {
             "success": True,
@@ -307,56 +897,62 @@ async def extract_invoice(pdf: UploadFile = File(...)):
         }
 
     except Exception as e:
-        print("\n========== ERROR ==========\n")
-        traceback.print_exc()
-        print("\n=========================\n")
+        logger.exception("Qwen OCR failed")
         err_msg = str(e)[:500] if str(e) else "Qwen OCR failed"
         raise HTTPException(status_code=500, detail=f"Qwen OCR failed: {err_msg}")
+    finally:
+        if render_task is not None and not render_task.done():
+            render_task.cancel()
+        if upload is not None:
+            upload.close()
 
 @app.post("/extract-weight")
 async def extract_weight(pdf: UploadFile = File(...)):
+    upload = None
+    render_task = None
     try:
-        file_bytes = await pdf.read()
+        upload = await read_upload(pdf)
         content_type = (pdf.content_type or "").lower().split(";")[0].strip()
+        is_image = is_image_upload(content_type, upload)
 
-        if content_type in IMAGE_CONTENT_TYPES:
-            weight_slip_page = Image.open(BytesIO(file_bytes))
-            if weight_slip_page.mode not in ("RGB", "RGBA"):
-                weight_slip_page = weight_slip_page.convert("RGB")
-            print("\nWeight slip image loaded")
+        key = cache_key(upload.sha, WEIGHT_PROMPT)
+        render_task = start_speculative_render(upload, is_image, key)
+        qwen_text = await probe_cache(key)
+        if qwen_text is not None:
+            logger.info("Cache hit, skipping Qwen call")
         else:
-            images = convert_from_bytes(file_bytes, dpi=300, poppler_path=POPPLER_PATH)
-            if not images:
-                raise Exception("PDF conversion failed")
-            weight_slip_page = images[0]
-            print("\nWeight slip PDF converted to image")
+            async def run_pipeline():
+                if is_image:
+                    weight_slip_page = Image.open(upload.spool)
+                    if weight_slip_page.mode not in ("RGB", "RGBA"):
+                        weight_slip_page = weight_slip_page.convert("RGB")
+                    logger.debug("Weight slip image loaded")
+                else:
+                    images = await (render_task if render_task is not None else render_pdf(upload))
+                    if not images:
+                        raise Exception("PDF conversion failed")
+                    weight_slip_page = images[0]
+                    logger.debug("Weight slip PDF converted to image")
+
+                qwen_text, validated = await call_qwen_weight(weight_slip_page)
+                if validated:
+                    await store_cache(key, qwen_text)
+                return qwen_text
 
-        qwen_text = call_qwen_weight(weight_slip_page)
+            qwen_text = await dedup_inflight(key, run_pipeline)
 
-        print("\n========== QWEN WEIGHT OUTPUT ==========\n")
-        print(qwen_text)
-        print("\n========================================\n")
+        logger.debug("Qwen weight output: %s", qwen_text)
 
-        # Parse the JSON response
+        # JSON mode means the response is the JSON object itself; the regex
+        # fallback only covers a model that ignores response_format.
         try:
-            json_match = re.search(r'\{[\s\S]*\}', qwen_text)
-            if json_match:
-                weight_data = json.loads(json_match.group(0))
-                weight_value = weight_data.get("weight")
-                
-                # Convert to float if it's a string
-                if weight_value:
-                    if isinstance(weight_value, str):
-                        # Remove any non-numeric characters except decimal point
-                        weight_value = float(''.join(c for c in weight_value if c.isdigit() or c == '.'))
-                    else:
-                        weight_value = float(weight_value)
-                else:
-                    weight_value = None
-            else:
-                weight_value = None
+            try:
+                weight_value = WeightOut.model_validate_json(qwen_text).weight
+            except ValidationError:
+                json_match = _JSON_RE.search(qwen_text)
+                weight_value = WeightOut.model_validate_json(json_match.group(0)).weight if json_match else None
         except Exception as e:
-            print(f"Error parsing weight: {e}")
+            logger.warning("Error parsing weight: %s", e)
             weight_value = None
 
         return {
@@ -365,17 +961,61 @@ async def extract_weight(pdf: UploadFile = File(...)):
         }
 
     except Exception as e:
-        print("\n========== ERROR ==========\n")
-        traceback.print_exc()
-        print("\n=========================\n")
+        logger.exception("Weight extraction failed")
         err_msg = str(e)[:500] if str(e) else "Weight extraction failed"
         raise HTTPException(status_code=500, detail=f"Weight extraction failed: {err_msg}")
+    finally:
+        if render_task is not None and not render_task.done():
+            render_task.cancel()
+        if upload is not None:
+            upload.close()
 
 @app.get("/health")
 def health():
     return {"status": "ok"}
 
+
+# ---------------- WARMUP ----------------
+# Minimal single-page blank PDF, just enough for pdftoppm to render
+_DUMMY_MIN_PDF = (
+    b"%PDF-1.1\n"
+    b"1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n"
+    b"2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj\n"
+    b"3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 72 72]>>endobj\n"
+    b"trailer<</Root 1 0 R>>\n"
+    b"%%EOF\n"
+)
+
+
+@app.on_event("startup")
+async def warmup():
+    """Pay the first-request tax at startup instead of on the first upload.
+
+    The first poppler call forks pdftoppm and loads its shared libs; the
+    first call to each endpoint negotiates TLS and HTTP/2. Failures here are
+    logged, not fatal — the service still starts.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(
+            _pdf_executor,
+            functools.partial(convert_from_bytes, _DUMMY_MIN_PDF, dpi=72,
+                              last_page=1, poppler_path=POPPLER_PATH),
+        )
+    except Exception as e:
+        logger.warning("Poppler warmup failed: %s", e)
+    for endpoint in endpoint_pool.endpoints:
+        try:
+            await endpoint.client.chat.completions.create(
+                model=MODEL_NAME,
+                messages=[{"role": "user", "content": "ping"}],
+                max_tokens=1,
+            )
+        except Exception as e:
+            logger.warning("Endpoint warmup failed for %s: %s", endpoint.base_url, e)
+
 # ---------------- RUN ----------------
 if __name__ == "__main__":
     import uvicorn
+    logging.basicConfig(level=logging.INFO)
     uvicorn.run(app, host="0.0.0.0", port=5000)